@@ -1,5 +1,6 @@
 # agent.py (complete updated version)
 import operator
+import time
 from typing import TypedDict, Annotated, List
 
 from langgraph.graph import StateGraph, END
@@ -12,14 +13,18 @@ from langchain_core.messages import (
     HumanMessage,
 )
 
-from config import llm, DB_CONFIG
+from config import llm, DB_CONFIG, SQL_MAX_RETRIES, SQL_RETRY_BUDGET_SECONDS
 from tools import sql_database_tool
 from database_utils import (
     initialize_comprehensive_log_table,
     add_to_comprehensive_log,
     get_schema_identifiers,
+    get_table_columns,
+    initialize_materialized_answers_table,
+    save_materialized_response,
 )
-from sql_validator import get_cased_identifiers, fix_sql_casing
+from sql_validator import get_cased_identifiers, fix_sql_casing, find_referenced_tables
+from materializer import lookup_materialized_answer
 
 
 # --- Agent State Definition ---
@@ -27,6 +32,13 @@ class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], operator.add]
     history: str
     error_count: int
+    sql_retry_count: int
+    last_sql_error: str
+    sql_started_at: float
+    sql_elapsed_ms: int
+    materialized_key: str
+    materialized_status: str
+    asked_standalone: bool
     user_query_for_log: str
     sql_query_for_log: str
     corrected_sql_query_for_log: str
@@ -56,6 +68,50 @@ def capture_user_query(state: AgentState):
     return state
 
 
+def materialized_lookup_node(state: AgentState):
+    """
+    Serves hot questions from the materialized_answers store, skipping SQL generation.
+    Also records whether the question was asked without prior context; only questions
+    that have run successfully on their own are materialized, so a hit here does not
+    depend on the current conversation.
+    """
+    print("--- ⚡ MATERIALIZED ANSWER LOOKUP ---")
+    question = state["messages"][-1].content
+    asked_standalone = all(
+        isinstance(m, HumanMessage) and m.content == question for m in state["messages"]
+    )
+
+    record = lookup_materialized_answer(DB_CONFIG, question)
+    if not record:
+        return {"materialized_key": "", "materialized_status": "", "asked_standalone": asked_standalone}
+
+    update = {
+        "asked_standalone": asked_standalone,
+        "materialized_key": record["question_key"],
+        "sql_query_for_log": record["sql_query"],
+        "corrected_sql_query_for_log": record["sql_query"],
+        "raw_tool_output_for_log": record["raw_result"],
+    }
+    if record.get("final_response"):
+        print("--- ⚡ SERVING MATERIALIZED RESPONSE ---")
+        update["materialized_status"] = "response"
+        update["messages"] = [AIMessage(content=record["final_response"])]
+    else:
+        print("--- ⚡ SERVING MATERIALIZED RESULT ---")
+        update["materialized_status"] = "result"
+    return update
+
+
+def materialized_route(state: AgentState):
+    """Skips to logging or synthesis on a materialized hit, otherwise runs the full pipeline."""
+    status = state.get("materialized_status")
+    if status == "response":
+        return "log_interaction_node"
+    if status == "result":
+        return "materialized_synthesis"
+    return "chief_router"
+
+
 def chief_router_node(state: AgentState):
     """Router to decide between querying the database or simple conversation."""
     print("--- 🧠 CHIEF ROUTER ---")
@@ -93,9 +149,46 @@ def route_logic(state: AgentState):
     return "synthesis_agent"
 
 
+def build_repair_prompt(state: AgentState) -> str:
+    """
+    Builds the feedback message for a failed query: the database error, the
+    query that produced it, and the schema of the tables it referenced.
+    """
+    failed_query = state.get("corrected_sql_query_for_log") or state.get("sql_query_for_log", "")
+    schema_identifiers = get_schema_identifiers(DB_CONFIG)
+    tables = find_referenced_tables(failed_query, schema_identifiers["tables"])
+
+    if tables:
+        table_columns = get_table_columns(DB_CONFIG, tables)
+        schema_slice = "\n".join(
+            f"- {table}({', '.join(columns)})" for table, columns in table_columns.items()
+        )
+    else:
+        # The query did not name any known table, so list what exists instead.
+        schema_slice = "Available tables: " + ", ".join(schema_identifiers["tables"])
+
+    last_error = state.get("last_sql_error", "")
+    if last_error.startswith("[TOOL_ERROR]"):
+        # The last attempt never produced a runnable query, so there is no failed SQL to show.
+        return (
+            "The previous attempt did not produce a valid sql_database_tool call. "
+            "Call sql_database_tool with {\"query\": \"...\"}.\n"
+            f"Error:\n{last_error}\n"
+            f"Relevant schema:\n{schema_slice}"
+        )
+
+    return (
+        "The previous SQL query failed. Fix it and call sql_database_tool again.\n"
+        f"Failed query:\n{failed_query}\n"
+        f"Database error:\n{last_error}\n"
+        f"Relevant schema:\n{schema_slice}"
+    )
+
+
 def tool_calling_agent(state: AgentState):
     """
     Generates the SQL query using the detailed schema prompt.
+    On a repair pass, the last database error and schema slice are appended.
     """
     print("--- 👨‍🏫 SQL QUERY GENERATOR ---")
     tools_to_bind = [sql_database_tool]
@@ -111,10 +204,21 @@ def tool_calling_agent(state: AgentState):
     )
 
     messages_for_llm = [SystemMessage(content=system_prompt)] + state["messages"]
+
+    update = {}
+    if not state.get("sql_started_at"):
+        update["sql_started_at"] = time.monotonic()
+    if state.get("last_sql_error"):
+        retry_count = state.get("sql_retry_count", 0) + 1
+        print(f"--- 🔁 SQL REPAIR ATTEMPT {retry_count}/{SQL_MAX_RETRIES} ---")
+        messages_for_llm.append(HumanMessage(content=build_repair_prompt(state)))
+        update["sql_retry_count"] = retry_count
+
     response = llm_with_tools.invoke(messages_for_llm)
 
     # Return the model response (may include tool_calls)
-    return {"messages": [response]}
+    update["messages"] = [response]
+    return update
 
 
 def tool_agent_has_tool_call(state: AgentState):
@@ -125,6 +229,20 @@ def tool_agent_has_tool_call(state: AgentState):
     return "synthesis_agent"
 
 
+def tool_error_result(state: AgentState, content: str, tool_call_id: str = "error"):
+    """
+    Builds the state update for a [TOOL_ERROR]. During a repair pass it counts as a
+    failed attempt, so sql_result_router can retry while attempts and time remain.
+    """
+    repairing = bool(state.get("sql_retry_count"))
+    return {
+        "messages": [ToolMessage(content=content, tool_call_id=tool_call_id)],
+        "raw_tool_output_for_log": content,
+        "error_count": state.get("error_count", 0) + 1,
+        "last_sql_error": content if repairing else "",
+    }
+
+
 def custom_tool_executor(state: AgentState):
     """
     Intercepts the generated SQL, validates and corrects casing issues,
@@ -134,11 +252,7 @@ def custom_tool_executor(state: AgentState):
     try:
         last_message = state["messages"][-1]
         if not getattr(last_message, "tool_calls", None):
-            return {
-                "messages": [
-                    ToolMessage(content="[TOOL_ERROR] No tool call found.", tool_call_id="error")
-                ]
-            }
+            return tool_error_result(state, "[TOOL_ERROR] No tool call found.")
 
         # Find the sql_database_tool call (in case multiple tool calls exist)
         sql_call = None
@@ -148,26 +262,14 @@ def custom_tool_executor(state: AgentState):
                 break
 
         if not sql_call:
-            return {
-                "messages": [
-                    ToolMessage(
-                        content="[TOOL_ERROR] Expected sql_database_tool call, but none found.",
-                        tool_call_id="error",
-                    )
-                ]
-            }
+            return tool_error_result(state, "[TOOL_ERROR] Expected sql_database_tool call, but none found.")
 
         tool_input = sql_call.get("args", {}) or {}
         original_sql_query = tool_input.get("query")
         if not original_sql_query:
-            return {
-                "messages": [
-                    ToolMessage(
-                        content="[TOOL_ERROR] Tool call missing 'query'.",
-                        tool_call_id=sql_call.get("id", "error"),
-                    )
-                ]
-            }
+            return tool_error_result(
+                state, "[TOOL_ERROR] Tool call missing 'query'.", sql_call.get("id", "error")
+            )
 
         print(f"Original Query from LLM: {original_sql_query}")
 
@@ -184,31 +286,45 @@ def custom_tool_executor(state: AgentState):
             tool_call_id=sql_call.get("id", "sql_database_tool"),
         )
 
+        failed = str(raw_result).startswith("[SQL_ERROR]")
+        started_at = state.get("sql_started_at") or time.monotonic()
+
         return {
             "messages": [tool_message],
             "sql_query_for_log": original_sql_query,
             "corrected_sql_query_for_log": corrected_sql_query,
             "raw_tool_output_for_log": str(raw_result),
+            "error_count": state.get("error_count", 0) + (1 if failed else 0),
+            "last_sql_error": str(raw_result) if failed else "",
+            "sql_elapsed_ms": int((time.monotonic() - started_at) * 1000),
         }
 
     except Exception as e:
         print(f"[ERROR] in custom_tool_executor: {e}")
-        return {
-            "messages": [
-                ToolMessage(content=f"[TOOL_ERROR] Could not execute tool: {e}", tool_call_id="error")
-            ]
-        }
+        return tool_error_result(state, f"[TOOL_ERROR] Could not execute tool: {e}")
 
 
-def synthesis_agent(state: AgentState):
-    """
-    Formats the final output and shows the corrected SQL query used.
-    This keeps your existing approach (LLM formats table), but now router/executor are stable.
-    """
-    print("--- ✍️ SYNTHESIS AGENT ---")
-    sql_query = state.get("corrected_sql_query_for_log") or state.get("sql_query_for_log", "No SQL query was run.")
+def sql_result_router(state: AgentState):
+    """After execution: send a failed query back for repair while retries and time budget remain."""
+    if not state.get("last_sql_error"):
+        return "synthesis_agent"
 
-    synthesis_prompt = f"""You are an expert data presentation assistant.
+    retry_count = state.get("sql_retry_count", 0)
+    elapsed = time.monotonic() - (state.get("sql_started_at") or time.monotonic())
+    if retry_count >= SQL_MAX_RETRIES:
+        print(f"--- ❌ SQL RETRIES EXHAUSTED ({retry_count}) ---")
+        return "synthesis_agent"
+    if elapsed >= SQL_RETRY_BUDGET_SECONDS:
+        print(f"--- ❌ SQL RETRY BUDGET EXCEEDED ({elapsed:.1f}s) ---")
+        return "synthesis_agent"
+
+    print("--- ROUTE: SQL REPAIR ---")
+    return "tool_agent"
+
+
+def build_synthesis_prompt(sql_query: str, context: List[BaseMessage]) -> str:
+    """Builds the presentation prompt shared by the synthesis nodes."""
+    return f"""You are an expert data presentation assistant.
 
 UNBREAKABLE RULES:
 1) Start with this exact dropdown:
@@ -222,16 +338,44 @@ UNBREAKABLE RULES:
 - If it contains [SQL_ERROR] or [TOOL_ERROR], apologize and ask to rephrase.
 
 Conversation Context:
-{state["messages"]}
+{context}
 """
 
-    response = llm.invoke(synthesis_prompt)
+
+def synthesis_agent(state: AgentState):
+    """
+    Formats the final output and shows the corrected SQL query used.
+    This keeps your existing approach (LLM formats table), but now router/executor are stable.
+    """
+    print("--- ✍️ SYNTHESIS AGENT ---")
+    sql_query = state.get("corrected_sql_query_for_log") or state.get("sql_query_for_log", "No SQL query was run.")
+
+    response = llm.invoke(build_synthesis_prompt(sql_query, state["messages"]))
+    return {"messages": [AIMessage(content=response.content)]}
+
+
+def materialized_synthesis_node(state: AgentState):
+    """
+    Formats a materialized result from the question and stored result only, so the
+    response cached for later hits does not carry anything from this session.
+    """
+    print("--- ✍️ MATERIALIZED SYNTHESIS ---")
+    context = [
+        HumanMessage(content=state["user_query_for_log"]),
+        ToolMessage(content=state["raw_tool_output_for_log"], tool_call_id="materialized_answer"),
+    ]
+    response = llm.invoke(build_synthesis_prompt(state["sql_query_for_log"], context))
     return {"messages": [AIMessage(content=response.content)]}
 
 
 def log_interaction_node(state: AgentState):
     """Final node to log the entire interaction."""
     print("--- 📝 LOGGING INTERACTION ---")
+    print(
+        f"SQL retries: {state.get('sql_retry_count', 0)}, "
+        f"failed executions: {state.get('error_count', 0)}, "
+        f"SQL stage time: {state.get('sql_elapsed_ms')} ms"
+    )
     add_to_comprehensive_log(
         db_config=DB_CONFIG,
         user_query=state.get("user_query_for_log"),
@@ -239,7 +383,18 @@ def log_interaction_node(state: AgentState):
         corrected_sql_query=state.get("corrected_sql_query_for_log"),
         raw_tool_output=state.get("raw_tool_output_for_log"),
         final_response=state["messages"][-1].content,
+        sql_retry_count=state.get("sql_retry_count", 0),
+        sql_elapsed_ms=state.get("sql_elapsed_ms"),
+        asked_standalone=state.get("asked_standalone", False),
     )
+    # Cache the synthesized response so the next hit on this result skips the LLM
+    if state.get("materialized_status") == "result":
+        save_materialized_response(
+            DB_CONFIG,
+            state["materialized_key"],
+            raw_result=state["raw_tool_output_for_log"],
+            final_response=state["messages"][-1].content,
+        )
     return state
 
 
@@ -248,18 +403,31 @@ def get_agent_app():
     """Configures and compiles the agentic graph."""
     print("--- Configuring and Compiling Agentic Graph ---")
     initialize_comprehensive_log_table(DB_CONFIG)
+    initialize_materialized_answers_table(DB_CONFIG)
 
     workflow = StateGraph(AgentState)
 
     workflow.add_node("capture_user_query", capture_user_query)
+    workflow.add_node("materialized_lookup", materialized_lookup_node)
     workflow.add_node("chief_router", chief_router_node)
     workflow.add_node("tool_agent", tool_calling_agent)
     workflow.add_node("tool_executor", custom_tool_executor)
     workflow.add_node("synthesis_agent", synthesis_agent)
+    workflow.add_node("materialized_synthesis", materialized_synthesis_node)
     workflow.add_node("log_interaction_node", log_interaction_node)
 
     workflow.set_entry_point("capture_user_query")
-    workflow.add_edge("capture_user_query", "chief_router")
+    workflow.add_edge("capture_user_query", "materialized_lookup")
+
+    workflow.add_conditional_edges(
+        "materialized_lookup",
+        materialized_route,
+        {
+            "chief_router": "chief_router",
+            "materialized_synthesis": "materialized_synthesis",
+            "log_interaction_node": "log_interaction_node",
+        },
+    )
 
     workflow.add_conditional_edges(
         "chief_router",
@@ -280,8 +448,17 @@ def get_agent_app():
         },
     )
 
-    workflow.add_edge("tool_executor", "synthesis_agent")
+    # Failed queries loop back to the generator with the error, within limits
+    workflow.add_conditional_edges(
+        "tool_executor",
+        sql_result_router,
+        {
+            "tool_agent": "tool_agent",
+            "synthesis_agent": "synthesis_agent",
+        },
+    )
     workflow.add_edge("synthesis_agent", "log_interaction_node")
+    workflow.add_edge("materialized_synthesis", "log_interaction_node")
     workflow.add_edge("log_interaction_node", END)
 
     app = workflow.compile()
@@ -22,6 +22,28 @@ DB_CONFIG = {
     "port": os.environ.get("DB_PORT", "5432"),
 }
 
+# --- UI Transcript Settings ---
+# Number of recent messages kept in session state and rendered on each rerun.
+UI_TRANSCRIPT_WINDOW = int(os.environ.get("UI_TRANSCRIPT_WINDOW", "20"))
+# Number of older messages fetched from conversation_history per "load more" click.
+UI_HISTORY_PAGE_SIZE = int(os.environ.get("UI_HISTORY_PAGE_SIZE", "20"))
+
+# --- SQL Self-Correction Settings ---
+# How many times a failed query is sent back to the SQL generator for repair.
+SQL_MAX_RETRIES = int(os.environ.get("SQL_MAX_RETRIES", "2"))
+# Stop retrying once the SQL stage has used this many seconds in total.
+SQL_RETRY_BUDGET_SECONDS = float(os.environ.get("SQL_RETRY_BUDGET_SECONDS", "20"))
+
+# --- Materialized Answer Settings ---
+# How many of the most frequent logged questions are kept precomputed.
+MATERIALIZE_TOP_N = int(os.environ.get("MATERIALIZE_TOP_N", "10"))
+# A question must have been logged at least this many times to be materialized.
+MATERIALIZE_MIN_HITS = int(os.environ.get("MATERIALIZE_MIN_HITS", "3"))
+# Seconds between background refresh passes (0 disables the background refresher).
+MATERIALIZE_REFRESH_SECONDS = int(os.environ.get("MATERIALIZE_REFRESH_SECONDS", "300"))
+# Refresh an answer after this many seconds even if its table counters look unchanged.
+MATERIALIZE_MAX_AGE_SECONDS = int(os.environ.get("MATERIALIZE_MAX_AGE_SECONDS", "3600"))
+
 # --- ChromaDB Client ---
 try:
     chroma_db_path = os.environ.get("CHROMA_PATH", "/tmp/chromadb_storage")
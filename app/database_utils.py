@@ -1,5 +1,6 @@
 import psycopg2
-from typing import Dict, List
+from psycopg2.extras import RealDictCursor
+from typing import Any, Dict, List, Optional, Tuple
 
 # --- CONVERSATION HISTORY FUNCTIONS (Used by UI) ---
 
@@ -17,23 +18,36 @@ def initialize_conversation_history_table(db_config: Dict[str, str]):
             );
         """)
         conn.commit()
+        # Scope rows to a UI session so transcripts can be paged per user (for backward compatibility)
+        cur.execute("""
+            ALTER TABLE conversation_history
+            ADD COLUMN IF NOT EXISTS session_id TEXT;
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS conversation_history_session_idx
+            ON conversation_history (session_id, id);
+        """)
+        conn.commit()
         conn.close()
     except Exception as e:
         print(f"[ERROR] Error initializing conversation history table: {e}")
 
-def add_to_conversation_history(db_config: Dict[str, str], speaker: str, message: str):
-    """Adds a message to the simple conversation_history table."""
+def add_to_conversation_history(db_config: Dict[str, str], speaker: str, message: str, session_id: Optional[str] = None) -> Optional[int]:
+    """Adds a message to the simple conversation_history table and returns its id."""
     try:
         conn = psycopg2.connect(**db_config)
         cur = conn.cursor()
         cur.execute(
-            "INSERT INTO conversation_history (speaker, message) VALUES (%s, %s);",
-            (speaker, message)
+            "INSERT INTO conversation_history (speaker, message, session_id) VALUES (%s, %s, %s) RETURNING id;",
+            (speaker, message, session_id)
         )
+        row_id = cur.fetchone()[0]
         conn.commit()
         conn.close()
+        return row_id
     except Exception as e:
         print(f"[ERROR] Error adding message to conversation history: {e}")
+        return None
 
 def get_recent_conversation_history(db_config: Dict[str, str], limit: int = 10) -> str:
     """Retrieves recent messages for the agent's context string."""
@@ -52,6 +66,27 @@ def get_recent_conversation_history(db_config: Dict[str, str], limit: int = 10)
         print(f"[ERROR] Error retrieving conversation history: {e}")
         return ""
 
+def get_conversation_history_page(db_config: Dict[str, str], session_id: str, limit: int, before_id: Optional[int] = None) -> List[Tuple[int, str, str]]:
+    """
+    Retrieves a page of a session's messages older than `before_id` (keyset paging).
+    Returns (id, speaker, message) tuples in chronological order.
+    """
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT id, speaker, message FROM conversation_history
+               WHERE session_id = %s AND (%s IS NULL OR id < %s)
+               ORDER BY id DESC LIMIT %s;""",
+            (session_id, before_id, before_id, limit)
+        )
+        rows = cur.fetchall()
+        conn.close()
+        return list(reversed(rows))
+    except Exception as e:
+        print(f"[ERROR] Error retrieving conversation history page: {e}")
+        return []
+
 
 # --- SCHEMA AND IDENTIFIER FUNCTIONS (Used by Agent and Validator) ---
 
@@ -90,6 +125,31 @@ def get_schema_identifiers(db_config: Dict[str, str]) -> Dict[str, List[str]]:
         print(f"[ERROR] Error fetching schema identifiers: {e}")
         return identifiers
 
+def get_table_columns(db_config: Dict[str, str], tables: List[str]) -> Dict[str, List[str]]:
+    """
+    Retrieves the columns of the given public tables, in ordinal order.
+    Used to hand the SQL generator a small schema slice when repairing a failed query.
+    """
+    columns = {table: [] for table in tables}
+    if not tables:
+        return columns
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = ANY(%s)
+            ORDER BY table_name, ordinal_position;
+        """, (list(tables),))
+        for table_name, column_name in cur.fetchall():
+            columns.setdefault(table_name, []).append(column_name)
+        conn.close()
+        return columns
+    except Exception as e:
+        print(f"[ERROR] Error fetching table columns: {e}")
+        return columns
+
 
 # --- COMPREHENSIVE LOGGING FUNCTIONS (UPDATED) ---
 
@@ -116,23 +176,200 @@ def initialize_comprehensive_log_table(db_config: dict):
             ADD COLUMN IF NOT EXISTS sql_query_corrected TEXT;
         """)
         conn.commit()
+        # Retry metrics for the SQL self-correction loop
+        cur.execute("""
+            ALTER TABLE comprehensive_agent_logs
+            ADD COLUMN IF NOT EXISTS sql_retry_count INTEGER DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS sql_elapsed_ms INTEGER;
+        """)
+        conn.commit()
+        # Whether the question was asked without earlier turns (used by the materializer)
+        cur.execute("""
+            ALTER TABLE comprehensive_agent_logs
+            ADD COLUMN IF NOT EXISTS asked_standalone BOOLEAN DEFAULT FALSE;
+        """)
+        conn.commit()
         conn.close()
         print("Comprehensive agent logs table initialized or already exists.")
     except Exception as e:
         print(f"Error initializing comprehensive agent logs table: {e}")
 
 
-def add_to_comprehensive_log(db_config: dict, user_query: str, final_response: str, sql_query: str = None, corrected_sql_query: str = None, raw_tool_output: str = None):
-    """Adds a structured log entry, including the corrected query, to the comprehensive_agent_logs table."""
+def add_to_comprehensive_log(db_config: dict, user_query: str, final_response: str, sql_query: str = None, corrected_sql_query: str = None, raw_tool_output: str = None, sql_retry_count: int = 0, sql_elapsed_ms: int = None, asked_standalone: bool = False):
+    """Adds a structured log entry, including the corrected query and retry metrics, to the comprehensive_agent_logs table."""
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO comprehensive_agent_logs (user_query, sql_query_generated, sql_query_corrected, raw_tool_output, final_agent_response, sql_retry_count, sql_elapsed_ms, asked_standalone) 
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""",
+            (user_query, sql_query, corrected_sql_query, raw_tool_output, final_response, sql_retry_count, sql_elapsed_ms, asked_standalone)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Error adding to comprehensive agent logs: {e}")
+
+# --- MATERIALIZED ANSWER FUNCTIONS (Used by Materializer and Agent) ---
+
+def initialize_materialized_answers_table(db_config: dict):
+    """Initializes the materialized_answers table that stores precomputed results for hot questions."""
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS materialized_answers (
+                question_key TEXT PRIMARY KEY,
+                user_query TEXT NOT NULL,
+                sql_query TEXT NOT NULL,
+                raw_result TEXT,
+                final_response TEXT,
+                referenced_tables TEXT,
+                table_counters TEXT,
+                refreshed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+        conn.close()
+        print("Materialized answers table initialized or already exists.")
+    except Exception as e:
+        print(f"Error initializing materialized answers table: {e}")
+
+
+def get_logged_query_counts(db_config: dict) -> List[Tuple[str, str, int, Any]]:
+    """
+    Returns every distinct question that ran SQL successfully at least once without
+    prior conversation context, as (user_query, sql_query, hits, last_standalone) tuples.
+    Hits count every successful run; the SQL is taken from the most recent standalone run,
+    so it never carries another conversation's context.
+    """
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT
+                user_query,
+                (array_agg(COALESCE(NULLIF(sql_query_corrected, ''), NULLIF(sql_query_generated, '')) ORDER BY timestamp DESC)
+                    FILTER (WHERE asked_standalone))[1],
+                COUNT(*) AS hits,
+                MAX(timestamp) FILTER (WHERE asked_standalone)
+            FROM comprehensive_agent_logs
+            WHERE NULLIF(user_query, '') IS NOT NULL
+              -- Chit-chat turns are logged with empty strings rather than NULLs
+              AND COALESCE(NULLIF(sql_query_corrected, ''), NULLIF(sql_query_generated, '')) IS NOT NULL
+              AND NULLIF(raw_tool_output, '') IS NOT NULL
+              AND raw_tool_output NOT LIKE '[SQL_ERROR]%'
+              AND raw_tool_output NOT LIKE '[TOOL_ERROR]%'
+            GROUP BY user_query
+            HAVING bool_or(asked_standalone);
+        """)
+        rows = cur.fetchall()
+        conn.close()
+        return rows
+    except Exception as e:
+        print(f"[ERROR] Error fetching logged query counts: {e}")
+        return []
+
+
+def get_table_modification_counters(db_config: dict, tables: List[str]) -> Dict[str, int]:
+    """
+    Returns inserted + updated + deleted tuple counts per table from pg_stat_user_tables.
+    A change in these counters means the table's data has changed.
+    """
+    if not tables:
+        return {}
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT relname, n_tup_ins + n_tup_upd + n_tup_del
+            FROM pg_stat_user_tables
+            WHERE schemaname = 'public' AND relname = ANY(%s);
+        """, (list(tables),))
+        counters = {relname: int(total) for relname, total in cur.fetchall()}
+        conn.close()
+        return counters
+    except Exception as e:
+        print(f"[ERROR] Error fetching table modification counters: {e}")
+        return {}
+
+
+def get_materialized_answer(db_config: dict, question_key: str) -> Optional[Dict[str, Any]]:
+    """Retrieves a materialized answer by its normalized question key, or None if absent."""
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(
+            """SELECT question_key, user_query, sql_query, raw_result, final_response, referenced_tables,
+                      table_counters, EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - refreshed_at)) AS age_seconds
+               FROM materialized_answers WHERE question_key = %s;""",
+            (question_key,)
+        )
+        row = cur.fetchone()
+        conn.close()
+        return dict(row) if row else None
+    except Exception as e:
+        print(f"[ERROR] Error fetching materialized answer: {e}")
+        return None
+
+
+def upsert_materialized_answer(db_config: dict, question_key: str, user_query: str, sql_query: str, raw_result: str, referenced_tables: str, table_counters: str, final_response: str = None):
+    """Inserts or refreshes a materialized answer and resets its refresh timestamp."""
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO materialized_answers (question_key, user_query, sql_query, raw_result, final_response, referenced_tables, table_counters, refreshed_at)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+               ON CONFLICT (question_key) DO UPDATE SET
+                   user_query = EXCLUDED.user_query,
+                   sql_query = EXCLUDED.sql_query,
+                   raw_result = EXCLUDED.raw_result,
+                   final_response = EXCLUDED.final_response,
+                   referenced_tables = EXCLUDED.referenced_tables,
+                   table_counters = EXCLUDED.table_counters,
+                   refreshed_at = CURRENT_TIMESTAMP;""",
+            (question_key, user_query, sql_query, raw_result, final_response, referenced_tables, table_counters)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"[ERROR] Error upserting materialized answer: {e}")
+
+
+def save_materialized_response(db_config: dict, question_key: str, raw_result: str, final_response: str):
+    """
+    Stores the synthesized response for a materialized result so later hits skip the LLM.
+    Only applies if the row still holds the raw_result the response was written from;
+    a refresh that ran in the meantime wins.
+    """
+    try:
+        conn = psycopg2.connect(**db_config)
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE materialized_answers SET final_response = %s WHERE question_key = %s AND raw_result = %s;",
+            (final_response, question_key, raw_result)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"[ERROR] Error saving materialized response: {e}")
+
+
+
+def delete_materialized_answers_except(db_config: dict, keep_keys: List[str]) -> int:
+    """Evicts every materialized answer whose question key is not in keep_keys."""
     try:
         conn = psycopg2.connect(**db_config)
         cur = conn.cursor()
         cur.execute(
-            """INSERT INTO comprehensive_agent_logs (user_query, sql_query_generated, sql_query_corrected, raw_tool_output, final_agent_response) 
-               VALUES (%s, %s, %s, %s, %s);""",
-            (user_query, sql_query, corrected_sql_query, raw_tool_output, final_response)
+            "DELETE FROM materialized_answers WHERE NOT (question_key = ANY(%s));",
+            (list(keep_keys),)
         )
+        evicted = cur.rowcount
         conn.commit()
         conn.close()
+        return evicted
     except Exception as e:
-        print(f"Error adding to comprehensive agent logs: {e}")
\ No newline at end of file
+        print(f"[ERROR] Error evicting materialized answers: {e}")
+        return 0
@@ -0,0 +1,160 @@
+# materializer.py
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    DB_CONFIG,
+    MATERIALIZE_TOP_N,
+    MATERIALIZE_MIN_HITS,
+    MATERIALIZE_REFRESH_SECONDS,
+    MATERIALIZE_MAX_AGE_SECONDS,
+)
+from tools import sql_database_tool
+from database_utils import (
+    initialize_materialized_answers_table,
+    get_logged_query_counts,
+    get_schema_identifiers,
+    get_table_modification_counters,
+    get_materialized_answer,
+    upsert_materialized_answer,
+    delete_materialized_answers_except,
+)
+from sql_validator import find_referenced_tables
+
+
+def normalize_question(text: str) -> str:
+    """Lower-cases and collapses whitespace. This is the only place question keys are computed."""
+    return " ".join((text or "").lower().split())
+
+
+def get_frequent_questions(db_config: dict) -> List[Tuple[str, str, str, int]]:
+    """
+    Groups logged questions by normalized key and returns the most frequent ones as
+    (question_key, user_query, sql_query, hits), using the variant most recently asked standalone.
+    """
+    grouped = {}
+    for user_query, sql_query, hits, last_asked in get_logged_query_counts(db_config):
+        key = normalize_question(user_query)
+        entry = grouped.get(key)
+        if entry is None:
+            grouped[key] = [user_query, sql_query, hits, last_asked]
+            continue
+        entry[2] += hits
+        if last_asked > entry[3]:
+            entry[0], entry[1], entry[3] = user_query, sql_query, last_asked
+
+    frequent = [
+        (key, user_query, sql_query, hits)
+        for key, (user_query, sql_query, hits, _) in grouped.items()
+        if hits >= MATERIALIZE_MIN_HITS
+    ]
+    frequent.sort(key=lambda row: row[3], reverse=True)
+    return frequent[:MATERIALIZE_TOP_N]
+
+
+def _is_stale(db_config: dict, record: Dict[str, Any]) -> bool:
+    """
+    A materialized answer is stale when its tables changed or it is older than the max age.
+    Uses the table list stored with the entry, so this costs a single pg_stat query.
+    """
+    if float(record.get("age_seconds") or 0) >= MATERIALIZE_MAX_AGE_SECONDS:
+        return True
+    tables = json.loads(record.get("referenced_tables") or "[]")
+    stored = json.loads(record.get("table_counters") or "{}")
+    return get_table_modification_counters(db_config, tables) != stored
+
+
+def refresh_answer(db_config: dict, question_key: str, user_query: str, sql_query: str, previous: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Re-runs the stored SQL and saves the fresh result.
+    The cached response is kept only if the result did not change.
+    """
+    schema_identifiers = get_schema_identifiers(db_config)
+    tables = find_referenced_tables(sql_query, schema_identifiers["tables"])
+    counters = get_table_modification_counters(db_config, tables)
+    raw_result = str(sql_database_tool.invoke({"query": sql_query}))
+    if raw_result.startswith("[SQL_ERROR]"):
+        print(f"[MATERIALIZER] Skipping '{question_key}': {raw_result}")
+        return None
+
+    final_response = None
+    if previous and previous.get("raw_result") == raw_result:
+        final_response = previous.get("final_response")
+
+    upsert_materialized_answer(
+        db_config,
+        question_key=question_key,
+        user_query=user_query,
+        sql_query=sql_query,
+        raw_result=raw_result,
+        referenced_tables=json.dumps(tables),
+        table_counters=json.dumps(counters, sort_keys=True),
+        final_response=final_response,
+    )
+    return get_materialized_answer(db_config, question_key)
+
+
+def refresh_materialized_answers(db_config: dict) -> int:
+    """
+    Materializes the most frequent logged questions, refreshing only stale entries,
+    and evicts entries that dropped out of the top N. Returns the refresh count.
+    """
+    refreshed = 0
+    frequent = get_frequent_questions(db_config)
+    for question_key, user_query, sql_query, hits in frequent:
+        existing = get_materialized_answer(db_config, question_key)
+        if existing and existing["sql_query"] == sql_query and not _is_stale(db_config, existing):
+            continue
+        if refresh_answer(db_config, question_key, user_query, sql_query, previous=existing):
+            refreshed += 1
+    evicted = delete_materialized_answers_except(db_config, [row[0] for row in frequent])
+    print(f"[MATERIALIZER] Refreshed {refreshed} and evicted {evicted} materialized answer(s).")
+    return refreshed
+
+
+def lookup_materialized_answer(db_config: dict, question: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the materialized answer for a question, refreshing it inline if its
+    tables changed since it was computed. Returns None when the question is not materialized.
+    """
+    question_key = normalize_question(question)
+    record = get_materialized_answer(db_config, question_key)
+    if not record:
+        return None
+
+    if _is_stale(db_config, record):
+        print(f"[MATERIALIZER] Refreshing stale answer for '{question_key}'")
+        record = refresh_answer(db_config, question_key, record["user_query"], record["sql_query"], previous=record)
+        if not record:
+            return None
+
+    return record
+
+
+def _refresh_loop(db_config: dict, interval: int):
+    while True:
+        try:
+            refresh_materialized_answers(db_config)
+        except Exception as e:
+            print(f"[ERROR] Materializer refresh failed: {e}")
+        time.sleep(interval)
+
+
+def start_materializer(db_config: dict = DB_CONFIG, interval: int = MATERIALIZE_REFRESH_SECONDS):
+    """Starts the background refresher thread. Does nothing if the interval is 0."""
+    initialize_materialized_answers_table(db_config)
+    if interval <= 0:
+        print("[MATERIALIZER] Background refresh disabled.")
+        return None
+    thread = threading.Thread(target=_refresh_loop, args=(db_config, interval), daemon=True, name="materializer")
+    thread.start()
+    print(f"[MATERIALIZER] Background refresh every {interval}s.")
+    return thread
+
+
+if __name__ == "__main__":
+    # One-shot refresh, e.g. for cron: python materializer.py
+    initialize_materialized_answers_table(DB_CONFIG)
+    refresh_materialized_answers(DB_CONFIG)
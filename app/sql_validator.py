@@ -10,6 +10,14 @@ def get_cased_identifiers(schema_identifiers: Dict[str, List[str]]) -> List[str]
                 cased.add(ident)
     return sorted(list(cased), key=len, reverse=True)
 
+def find_referenced_tables(query: str, tables: List[str]) -> List[str]:
+    """Returns the schema tables mentioned in the query (case-insensitive, whole word)."""
+    referenced = []
+    for table in tables:
+        if re.search(rf'\b{re.escape(table)}\b', query, re.IGNORECASE):
+            referenced.append(table)
+    return referenced
+
 def fix_sql_casing(query: str, cased_identifiers: List[str]) -> str:
     corrected = query
 
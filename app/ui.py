@@ -1,14 +1,17 @@
 # ui.py
 import time
+import uuid
 import streamlit as st
 from langchain_core.messages import HumanMessage, AIMessage
 
 from agent import get_agent_app
-from config import DB_CONFIG
+from materializer import start_materializer
+from config import DB_CONFIG, UI_TRANSCRIPT_WINDOW, UI_HISTORY_PAGE_SIZE
 from database_utils import (
     initialize_conversation_history_table,
     add_to_conversation_history,
     get_recent_conversation_history,
+    get_conversation_history_page,
 )
 
 # --- 1) PAGE CONFIGURATION ---
@@ -20,8 +23,34 @@ st.set_page_config(
 )
 
 # --- 2) SESSION STATE INITIALIZATION ---
+# Only the most recent UI_TRANSCRIPT_WINDOW messages live in session state; older
+# turns are read back from conversation_history on demand.
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex  # scopes conversation_history rows to this session
 if "messages" not in st.session_state:
-    st.session_state.messages = []  # [{"role": "user"|"assistant", "content": "..."}]
+    st.session_state.messages = []  # [{"role": "user"|"assistant", "content": "...", "id": conversation_history id or None}]
+if "agent_messages" not in st.session_state:
+    st.session_state.agent_messages = []  # cached HumanMessage/AIMessage, parallel to messages
+if "older_messages" not in st.session_state:
+    st.session_state.older_messages = []  # pages loaded from conversation_history, oldest first
+
+
+def append_message(role: str, content: str, row_id: int = None):
+    """Adds a message to the transcript window and its cached LangChain counterpart."""
+    st.session_state.messages.append({"role": role, "content": content, "id": row_id})
+    agent_message = HumanMessage(content=content) if role == "user" else AIMessage(content=content)
+    st.session_state.agent_messages.append(agent_message)
+
+    # Trim both lists together so they stay aligned, and never leave an assistant
+    # reply at the front without the question it answers.
+    while len(st.session_state.messages) > UI_TRANSCRIPT_WINDOW or (
+        st.session_state.messages and st.session_state.messages[0]["role"] == "assistant"
+    ):
+        trimmed = st.session_state.messages.pop(0)
+        st.session_state.agent_messages.pop(0)
+        # Keep loaded history contiguous: persisted rows leaving the window join the loaded pages.
+        if st.session_state.older_messages and trimmed.get("id") is not None:
+            st.session_state.older_messages.append(trimmed)
 
 # --- 3) UI STYLING & SIDEBAR ---
 st.markdown(
@@ -81,7 +110,10 @@ with st.sidebar:
 def initialize_system():
     # Ensure history table exists before any reads/writes
     initialize_conversation_history_table(DB_CONFIG)
-    return get_agent_app()
+    app = get_agent_app()
+    # Keep answers to the most frequent questions precomputed in the background
+    start_materializer(DB_CONFIG)
+    return app
 
 agent_app = initialize_system()
 
@@ -94,7 +126,32 @@ def stream_response(text: str):
 # --- 6) MAIN CHAT INTERFACE ---
 st.markdown('<p class="header">Chat with your Database</p>', unsafe_allow_html=True)
 
-# Display past messages
+# Older turns are only fetched once per page, when the user asks for them.
+load_col, hide_col = st.columns(2)
+with load_col:
+    if st.button("Load earlier messages"):
+        # Page backwards from the oldest row of this session already on screen.
+        shown_ids = [m["id"] for m in st.session_state.older_messages + st.session_state.messages if m.get("id") is not None]
+        older_rows = get_conversation_history_page(
+            DB_CONFIG,
+            session_id=st.session_state.session_id,
+            limit=UI_HISTORY_PAGE_SIZE,
+            before_id=min(shown_ids) if shown_ids else None,
+        )
+        st.session_state.older_messages[:0] = [
+            {"role": "user" if speaker == "User" else "assistant", "content": content, "id": row_id}
+            for row_id, speaker, content in older_rows
+        ]
+with hide_col:
+    if st.session_state.older_messages and st.button("Hide earlier messages"):
+        st.session_state.older_messages = []
+
+for message in st.session_state.older_messages:
+    avatar = "👤" if message["role"] == "user" else "🤖"
+    with st.chat_message(message["role"], avatar=avatar):
+        st.markdown(message["content"])
+
+# Display recent messages
 for message in st.session_state.messages:
     avatar = "👤" if message["role"] == "user" else "🤖"
     with st.chat_message(message["role"], avatar=avatar):
@@ -104,21 +161,17 @@ for message in st.session_state.messages:
 prompt = st.chat_input("Ask your database a question...")
 if prompt:
     # show user message immediately
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    append_message("user", prompt)
     with st.chat_message("user", avatar="👤"):
         st.markdown(prompt)
 
-    # build messages for agent
-    messages_for_agent = []
-    for msg in st.session_state.messages:
-        if msg["role"] == "user":
-            messages_for_agent.append(HumanMessage(content=msg["content"]))
-        else:
-            messages_for_agent.append(AIMessage(content=msg["content"]))
+    # reuse the cached LangChain messages instead of rebuilding them every turn
+    messages_for_agent = list(st.session_state.agent_messages)
 
     # fetch recent conversation history string (DB-backed)
     history_str = get_recent_conversation_history(DB_CONFIG, limit=10)
 
+    user_row_id = agent_row_id = None
     with st.chat_message("assistant", avatar="🤖"):
         with st.spinner("Agent is thinking..."):
             try:
@@ -128,6 +181,9 @@ if prompt:
                         "history": history_str,
                         # keep these optional keys if your AgentState expects them
                         "error_count": 0,
+                        "sql_retry_count": 0,
+                        "last_sql_error": "",
+                        "sql_started_at": 0.0,
                         "user_query_for_log": "",
                         "sql_query_for_log": "",
                         "corrected_sql_query_for_log": "",
@@ -140,13 +196,23 @@ if prompt:
                 # Stream output (or use st.markdown(bot_response) if you prefer)
                 st.write_stream(stream_response(bot_response))
 
+                retry_count = final_state.get("sql_retry_count", 0)
+                if retry_count:
+                    final_output = final_state.get("raw_tool_output_for_log") or ""
+                    failed = final_output.startswith(("[SQL_ERROR]", "[TOOL_ERROR]"))
+                    outcome = "still failing" if failed else "corrected"
+                    st.caption(f"🔁 SQL {outcome} after {retry_count} retr{'y' if retry_count == 1 else 'ies'}.")
+
                 # persist to DB conversation history
-                add_to_conversation_history(DB_CONFIG, "User", prompt)
-                add_to_conversation_history(DB_CONFIG, "Agent", bot_response)
+                session_id = st.session_state.session_id
+                user_row_id = add_to_conversation_history(DB_CONFIG, "User", prompt, session_id=session_id)
+                agent_row_id = add_to_conversation_history(DB_CONFIG, "Agent", bot_response, session_id=session_id)
 
             except Exception as e:
                 bot_response = f"🚨 An error occurred: {e}"
                 st.error(bot_response)
 
     # store assistant message in session state
-    st.session_state.messages.append({"role": "assistant", "content": bot_response})
+    if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+        st.session_state.messages[-1]["id"] = user_row_id
+    append_message("assistant", bot_response, row_id=agent_row_id)